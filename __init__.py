@@ -1,2 +1,2 @@
 #
-from poverlap import poverlap, fixle, bed_sample, main
+from .poverlap import poverlap, fixle, bed_sample, main
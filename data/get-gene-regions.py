@@ -9,4 +9,4 @@ refGene = db.refGene
 
 for g in refGene.all():
     for feat in g.gene_features:
-        print "\t".join(map(str, feat))
+        print("\t".join(map(str, feat)))
@@ -3,11 +3,21 @@
 import os
 import sys
 import json
+from io import StringIO
+from shlex import quote
+from subprocess import Popen, PIPE
+from bisect import bisect_left, bisect_right
+from itertools import chain, repeat
+from math import sqrt
+from random import Random
+from threading import Thread
+from operator import length_hint
 from commandr import command, Run
 from toolshed import nopen, reader
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count, Pool as ProcessPool
 from multiprocessing.dummy import Pool
-from tempfile import mktemp as _mktemp
+from tempfile import mktemp as _mktemp, mkdtemp
+from shutil import rmtree
 import atexit
 
 from signal import signal, SIGPIPE, SIG_DFL
@@ -18,6 +28,11 @@ if NCPUS > 4: NCPUS -= 1
 
 SEP = "&*#Z"
 
+# unless exact_n is set, shuffling stops once the p-value is clearly below
+# P_LOW or above P_HIGH, but not before MIN_SHUFFLES have been run.
+P_LOW, P_HIGH = 0.001, 0.5
+MIN_SHUFFLES = 100
+
 
 def mktemp(*args, **kwargs):
     def rm(f):
@@ -33,14 +48,39 @@ def mktemp(*args, **kwargs):
 def checkX(cmd):
     for p in os.environ['PATH'].split(":"):
         if os.access(os.path.join(p, cmd), os.X_OK):
-            break
+            return os.path.join(p, cmd)
     else:
         raise Exception("executable for '%s' not found" % cmd)
 
 checkX('bedtools')
+# the commands use process substitution: <(...) so they must run in bash.
+BASH = checkX('bash')
 
-def run(cmd):
-    proc = nopen("|%s" % cmd.lstrip("|"), mode=None)
+def popen(cmd, stdin=None):
+    """
+    Start `cmd` in bash with stdout and stderr as text pipes. Unlike
+    nopen("|cmd") this sets no preexec_fn and keeps close_fds=False, so
+    python can use posix_spawn/vfork rather than fork and does not walk the
+    fd table for each of the many shuffle commands.
+    If `stdin` is given, that text is written to the command's stdin from a
+    thread so reading the output can't deadlock.
+    """
+    proc = Popen(cmd, shell=True, executable=BASH, stdout=PIPE, stderr=PIPE,
+                 stdin=None if stdin is None else PIPE, close_fds=False,
+                 universal_newlines=True)
+    if stdin is not None:
+        def feed():
+            try:
+                proc.stdin.write(stdin)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass  # the error is reported by check_proc
+        Thread(target=feed, daemon=True).start()
+    return proc
+
+
+def run(cmd, stdin=None):
+    proc = popen(cmd.lstrip("|"), stdin)
     ret = next(proc.stdout).strip() or '0'
     check_proc(proc, cmd)
     return ret
@@ -57,7 +97,24 @@ def check_proc(proc, cmd=''):
     del proc
 
 
-def run_metric(cmd, metric=None):
+def drain_stderr(proc):
+    """
+    Read all of the stderr of `proc` in a thread so that a command which
+    writes more than a pipe holds (~64KB) to it can't block while its stdout
+    is read. Call the returned function before check_proc to collect it.
+    """
+    err = []
+    thread = Thread(target=lambda: err.append(proc.stderr.read()), daemon=True)
+    thread.start()
+
+    def collect():
+        thread.join()
+        proc.stderr.close()
+        proc.stderr = StringIO("".join(err))
+    return collect
+
+
+def run_metric(cmd, metric=None, stdin=None):
     """
     Metric can be a string, e.g. "wc -l" or a python callable that consumes
     lines of input and returns a single value.
@@ -72,39 +129,383 @@ def run_metric(cmd, metric=None):
     The lines sent to the metric function will be the result of bedtools
     intersect -wo -- so that both the -a and -b intervals will be present
     in each line.
+
+    If `stdin` is given, it is sent to `cmd`, e.g. `-b stdin`.
     """
 
     if metric is None:
         cmd, metric = cmd
-    if isinstance(metric, basestring):
-        return float(run("%s | %s" % (cmd, metric)))
+    if isinstance(metric, str):
+        return float(run("%s | %s" % (cmd, metric), stdin))
     else:
-        proc = nopen("|%s" % cmd, mode=None)
+        proc = popen(cmd, stdin)
         res = metric(proc.stdout)
         check_proc(proc, cmd)
         assert isinstance(res, (int, float))
         return res
 
 
+def run_batch(args):
+    """
+    Run `cmd | metric` once for each of `seeds` from a single shell and
+    return the list of values. This pays the cost of starting the shell once
+    per batch rather than once per shuffle. `cmd` sees the seed as $seed.
+    """
+    cmd, metric, seeds = args
+    seed_file = write_seeds(seeds)
+    # read the seeds on fd 3 so nothing in cmd can consume them from stdin.
+    script = ("while read seed <&3; do {cmd} | {metric}; done 3< {seed_file}"
+              .format(**locals()))
+    proc = popen(script)
+    collect = drain_stderr(proc)
+    res = [float(x.strip() or '0') for x in proc.stdout]
+    collect()
+    check_proc(proc, script)
+    assert len(res) == len(seeds), (len(res), len(seeds), script)
+    return res
+
+
+def run_xargs(cmd, metric, seeds, ncpus):
+    """
+    Run `cmd | metric` once for each of `seeds` with `ncpus` bash processes
+    started by `xargs -P`, each looping over its share of the seeds, and
+    yield the values as they are written. No python thread or pool is
+    involved. `cmd` sees the seed as $seed.
+    """
+    k = -(-len(seeds) // ncpus)
+    bash, seed_file = BASH, write_seeds(seeds)
+    loop = quote('for seed in "$@"; do {cmd} | {metric}; done'
+                 .format(**locals()))
+    script = ("xargs -n {k} -P {ncpus} {bash} -c {loop} _ < {seed_file}"
+              .format(**locals()))
+    proc = popen(script)
+    collect = drain_stderr(proc)
+    for line in proc.stdout:
+        yield float(line.strip() or '0')
+    collect()
+    check_proc(proc, script)
+
+
+def trial_seeds(n, seed=None):
+    """
+    Draw one seed for each of `n` shuffles from `seed` so that a run can be
+    repeated exactly. Each shuffle gets its own random stream whether it runs
+    in python, bedtools shuffle -seed, local-shuffle or bed-sample --seed.
+    """
+    rng = Random(None if seed is None else int(seed))
+    return [rng.getrandbits(31) for _ in range(n)]
+
+
+def split_seeds(seeds, nbatches=NCPUS):
+    """
+    split `seeds` into at most `nbatches` batches of nearly equal size.
+    """
+    return [seeds[i::nbatches] for i in range(min(len(seeds), nbatches))]
+
+
+def write_seeds(seeds):
+    with open(mktemp(suffix=".seeds"), "w") as fh:
+        fh.write("".join("%d\n" % s for s in seeds))
+    return fh.name
+
+
 def extend_bed(fin, fout, bases):
     # `bedtools slop`
 
     # we're extending both a.bed and b.bed by this distance
     # so divide by 2.
-    bases /= 2
+    bases //= 2
     with nopen(fout, 'w') as fh:
-        for toks in (l.rstrip("\r\n").split("\t") for l in nopen(fin)):
-            toks[1] = max(0, int(toks[1]) - bases)
-            toks[2] = max(0, int(toks[2]) + bases)
-            if toks[1] > toks[2]:  # negative distances
-                toks[1] = toks[2] = (toks[1] + toks[2]) / 2
-            assert toks[1] <= toks[2]
-            print("\t".join(map(str, toks)), file=fh)
+        buf, size = [], 0
+        # only the coordinates change so don't split the remaining columns.
+        for toks in (l.rstrip("\r\n").split("\t", 3) for l in nopen(fin)):
+            s = max(0, int(toks[1]) - bases)
+            e = max(0, int(toks[2]) + bases)
+            if s > e:  # negative distances
+                s = e = (s + e) // 2
+            line = "%s\t%d\t%d%s\n" % (toks[0], s, e,
+                                       "\t" + toks[3] if len(toks) > 3 else "")
+            buf.append(line)
+            size += len(line)
+            # write in ~64KB blocks rather than line by line.
+            if size > 65536:
+                fh.write("".join(buf))
+                buf, size = [], 0
+        fh.write("".join(buf))
     return fh.name
 
 
+def shift_offsets(k, dist, rng):
+    """
+    draw `k` random offsets in [-dist, dist] from the random.Random `rng` in
+    a single pass. this is about twice as fast as calling randint for each
+    interval.
+    """
+    random, span = rng.random, 2 * dist + 1
+    return [int(random() * span) - dist for _ in range(k)]
+
+
+def shift_lines(lines, dist, rng):
+    """
+    move the start and end of each of the BED `lines` (without newlines) by
+    a random offset in [-dist, dist] drawn from `rng`. As in local-shuffle.
+    """
+    out = []
+    for line, d in zip(lines, shift_offsets(len(lines), dist, rng)):
+        toks = line.split("\t", 3)
+        toks[1] = str(max(0, int(toks[1]) + d))
+        toks[2] = str(max(0, int(toks[2]) + d))
+        out.append("\t".join(toks) + "\n")
+    return out
+
+
+def is_header(line):
+    """
+    True for the blank, comment, track and browser lines that bedtools skips.
+    """
+    return not line.strip() or line.startswith(("#", "track", "browser"))
+
+
+def read_intervals(bed):
+    """
+    read the chrom, start, end of each interval in `bed` into a dict of
+    chrom => ([starts], [ends])
+    """
+    intervals = {}
+    for toks in (l.split("\t", 3) for l in nopen(bed) if not is_header(l)):
+        starts, ends = intervals.setdefault(toks[0], ([], []))
+        starts.append(int(toks[1]))
+        ends.append(int(toks[2]))
+    return intervals
+
+
+def extend_intervals(intervals, bases):
+    """
+    in-memory `extend_bed` for the output of `read_intervals`.
+    """
+    bases //= 2
+    for starts, ends in intervals.values():
+        for i, (s, e) in enumerate(zip(starts, ends)):
+            s, e = max(0, s - bases), max(0, e + bases)
+            if s > e:  # negative distances
+                s = e = (s + e) // 2
+            starts[i], ends[i] = s, e
+
+
+def index_intervals(intervals):
+    """
+    sort the starts and the ends (independently) for each chrom so that
+    overlaps can be counted with 2 binary searches per query. the positions
+    of any empty intervals are kept as well, see `LocalOverlap.count`.
+    """
+    return dict((chrom, (sorted(starts), sorted(ends),
+                         sorted(s for s, e in zip(starts, ends) if s >= e)))
+                for chrom, (starts, ends) in intervals.items())
+
+
+class PerProcess(object):
+    """
+    Base for the objects that are sent to other processes, e.g. the workers
+    of `trials_pool` or an IPython client's map. Subclasses set `args` to
+    their constructor arguments.
+    """
+
+    def __reduce__(self):
+        # pickle only the arguments so each process reads and indexes the
+        # files once and reuses them for every later batch.
+        return (cached_overlap, (self.__class__,) + self.args)
+
+
+class InProcessOverlap(PerProcess):
+    """
+    Base for the in-process counts. Subclasses define `count(rng=None)`.
+    """
+
+    def trials(self, seeds):
+        """
+        run a shuffle for each of `seeds` in one task so the pool dispatches
+        batches rather than single shuffles.
+        """
+        return [self.count(Random(seed)) for seed in seeds]
+
+
+class LocalOverlap(InProcessOverlap):
+    """
+    In-process equivalent of:
+
+        bedtools intersect -wo -a {a} -b <(local-shuffle {b} --loc {dist}) | wc -l
+
+    `a` and `b` are read and `a` is indexed once, then each call shifts the
+    intervals in `b` (and `a` if shuffle_both) by up to `dist` bases and
+    counts the overlapping pairs without starting any processes.
+    If `overlap_distance` is given, both are extended as by `extend_bed`.
+    Intervals overlap if each starts before the other ends, also when one
+    is empty, e.g. zero-length, collapsed by a negative overlap_distance or
+    clamped at 0 by the shift.
+    """
+
+    def __init__(self, a, b, dist, shuffle_both=False, overlap_distance=0):
+        self.args = (a, b, dist, shuffle_both, overlap_distance)
+        self.a = read_intervals(a)
+        self.b = read_intervals(b)
+        if overlap_distance != 0:
+            extend_intervals(self.a, overlap_distance)
+            extend_intervals(self.b, overlap_distance)
+        self.dist = abs(int(dist))
+        self.shuffle_both = shuffle_both
+        self.index = index_intervals(self.a)
+
+    def shift(self, intervals, rng):
+        shifted = {}
+        for chrom, (starts, ends) in intervals.items():
+            d = shift_offsets(len(starts), self.dist, rng)
+            shifted[chrom] = ([max(0, s + o) for s, o in zip(starts, d)],
+                              [max(0, e + o) for e, o in zip(ends, d)])
+        return shifted
+
+    def count(self, rng=None):
+        """
+        count the overlapping pairs after shifting with the random.Random
+        `rng` or, if it is None, in their original locations.
+        """
+        index = self.index
+        if rng is not None and self.shuffle_both:
+            index = index_intervals(self.shift(self.a, rng))
+        n = 0
+        for chrom, (starts, ends) in self.b.items():
+            if not chrom in index: continue
+            astarts, aends, empty = index[chrom]
+            # b is shifted as it is counted so no shuffled copy is made.
+            # a overlaps [s, e) iff a.start < e and a.end > s. every a with
+            # a.end <= s also has a.start < e so subtracting is safe, unless
+            # [s, e) is empty: then an empty a at s is in neither count.
+            offsets = repeat(0) if rng is None else \
+                shift_offsets(len(starts), self.dist, rng)
+            for s, e, d in zip(starts, ends, offsets):
+                s, e = s + d, e + d
+                if s < 0:  # clamped at 0 as by `shift`
+                    s, e = 0, max(0, e)
+                n += bisect_left(astarts, e) - bisect_right(aends, s)
+                if s >= e:
+                    n += bisect_right(empty, s) - bisect_left(empty, e)
+        # a float, as run_metric gives for 'wc -l'.
+        return float(n)
+
+
+class SampleOverlap(InProcessOverlap):
+    """
+    In-process equivalent of fixle's:
+
+        bedtools intersect -wo -a {a} -b <(bed-sample {other} --n {k}) | wc -l
+
+    `a` never moves so it is indexed once; each call samples `k` intervals
+    from `other` and counts their overlaps by binary search rather than
+    starting bed-sample and bedtools.
+    """
+
+    def __init__(self, a, b, other, k):
+        self.args = (a, b, other, k)
+        a, b, other = read_intervals(a), read_intervals(b), read_intervals(other)
+        self.index = index_intervals(a)
+        self.b, self.other = flat_intervals(b), flat_intervals(other)
+        self.k = k
+
+    def count(self, rng=None):
+        """
+        count the overlapping pairs for `k` intervals sampled from `other`
+        with the random.Random `rng` or, if it is None, for `b`.
+        """
+        index, n = self.index, 0
+        b = self.b if rng is None else rng.sample(self.other, self.k)
+        for chrom, s, e in b:
+            if not chrom in index: continue
+            astarts, aends, empty = index[chrom]
+            # see LocalOverlap.count
+            n += bisect_left(astarts, e) - bisect_right(aends, s)
+            if s >= e:
+                n += bisect_right(empty, s) - bisect_left(empty, e)
+        return float(n)
+
+
+def flat_intervals(intervals):
+    """
+    list of (chrom, start, end) from the output of `read_intervals`.
+    """
+    return [(chrom, s, e) for chrom, (starts, ends) in intervals.items()
+            for s, e in zip(starts, ends)]
+
+
+class PipedShuffle(PerProcess):
+    """
+    Run `cmd | metric` for a shuffle where `cmd` reads the shuffled `bed`
+    from stdin, e.g. `bedtools intersect -wo -a {a} -b stdin`. `bed` is read
+    once and each shuffle moves its intervals by up to `dist` bases or, if
+    `k` is given, samples `k` of them, in-process. So no local-shuffle or
+    bed-sample interpreter is started for each shuffle.
+    """
+
+    def __init__(self, cmd, bed, dist=None, k=None):
+        self.args = (cmd, bed, dist, k)
+        self.cmd, self.dist, self.k = cmd, dist, k
+        with nopen(bed) as fh:
+            self.lines = [l.rstrip("\r\n") for l in fh if not is_header(l)]
+
+    def shuffle(self, rng):
+        if self.k is not None:
+            return "".join(l + "\n" for l in rng.sample(self.lines, self.k))
+        return "".join(shift_lines(self.lines, self.dist, rng))
+
+    def __call__(self, args):
+        metric, seed = args
+        return run_metric("seed=%d; %s" % (seed, self.cmd), metric,
+                          self.shuffle(Random(seed)))
+
+
+_OVERLAPS = {}
+
+def cached_overlap(cls, *args):
+    """
+    cls(*args), created at most once per process. It is created again if
+    any of `args` that is a file has changed size or modification time,
+    e.g. when a temporary file name is reused by a later run.
+    """
+    key = (cls,) + args
+    stamp = tuple((st.st_size, st.st_mtime_ns) for st in
+                  (os.stat(arg) for arg in args
+                   if isinstance(arg, str) and os.path.isfile(arg)))
+    if not key in _OVERLAPS or _OVERLAPS[key][0] != stamp:
+        _OVERLAPS[key] = (stamp, cls(*args))
+    return _OVERLAPS[key][1]
+
+
+_TRIALS = None
+
+def init_trials(cls, args):
+    """
+    Pool initializer: build the cls(*args) that `run_trials` uses, once per
+    worker process.
+    """
+    global _TRIALS
+    _TRIALS = cached_overlap(cls, *args)
+
+
+def run_trials(seeds):
+    return _TRIALS.trials(seeds)
+
+
+def trials_pool(local, ncpus):
+    """
+    A multiprocessing.Pool of `ncpus` processes that each read and index the
+    files of the InProcessOverlap `local` once and then run its trials. The
+    counting holds the GIL, so the threads of pmap would run it one at a
+    time.
+    """
+    return ProcessPool(ncpus, init_trials, (local.__class__, local.args))
+
+
 @command('fixle')
-def fixle(bed, atype, btype, type_col=4, metric='wc -l', n=100, ncpus=-1):
+def fixle(bed, atype, btype, type_col=4, metric='wc -l', n=100, ncpus=-1,
+          seed=None, exact_n=False):
     """\
     From Haiminen et al in BMC Bioinformatics 2008, 9:336 (and R's `cooccur`).
     `bed` may contain, e.g. 20 TFBS as defined by the type in `type_col`.
@@ -120,6 +521,11 @@ def fixle(bed, atype, btype, type_col=4, metric='wc -l', n=100, ncpus=-1):
         metric - a string that indicates a program that consumes BED intervals
         ncpus - number cpus to use -- if a callable does the parallelization
                 use, e.g. Pool(5).map or Ipython Client[:].map
+        seed - seed for the shuffles; runs with the same seed give the same
+               result. Default is a random seed.
+        exact_n - always run all `n` shuffles. By default, shuffling stops
+                  early once the p-value is clearly below 0.001 or above
+                  0.5 (after at least 100 shuffles).
     """
     type_col -= 1
     n_btypes = 0
@@ -127,48 +533,71 @@ def fixle(bed, atype, btype, type_col=4, metric='wc -l', n=100, ncpus=-1):
     with nopen(mktemp(), 'w') as afh, \
             nopen(mktemp(), 'w') as ofh, \
             nopen(mktemp(), 'w') as bfh:
-        for toks in (l.rstrip("\r\n").split("\t") for l in nopen(bed)):
-            if toks[type_col] == atype:
-                print("\t".join(toks), file=afh)
+        for line in (l.rstrip("\r\n") for l in nopen(bed)):
+            # split no further than the type column and write the line as-is
+            itype = line.split("\t", type_col + 1)[type_col]
+            if itype == atype:
+                print(line, file=afh)
             else:
-                print("\t".join(toks), file=ofh)
-                if toks[type_col] == btype:
-                    print("\t".join(toks), file=bfh)
+                print(line, file=ofh)
+                if itype == btype:
+                    print(line, file=bfh)
                     n_btypes += 1
     assert n_btypes > 0, ("no intervals found for", btype)
 
     a, b, other = afh.name, bfh.name, ofh.name
     orig_cmd = "bedtools intersect -wo -a {a} -b {b}".format(**locals())
-    script = __file__
-    bsample = '<(python {script} bed-sample {other} --n {n_btypes})'.format(**locals())
+    # run the subcommands with this interpreter, e.g. pypy3
+    python, script = sys.executable, __file__
+    bsample = ('<({python} {script} bed-sample {other} --n {n_btypes} '
+               '--seed $seed)'.format(**locals()))
     shuf_cmd = "bedtools intersect -wo -a {a} -b {bsample}".format(**locals())
-    return json.dumps(gen_results(orig_cmd, metric, pmap, n, shuf_cmd))
+
+    local = piped = None
+    if 'wc -l' in (metric if isinstance(metric, (tuple, list)) else [metric]):
+        # the default count is done in-process, see SampleOverlap
+        local = SampleOverlap(a, b, other, n_btypes)
+    if not is_count_only(metric):
+        # other metrics get the sample on stdin, see PipedShuffle
+        piped = PipedShuffle("bedtools intersect -wo -a {a} -b stdin"
+                             .format(**locals()), other, k=n_btypes)
+    return json.dumps(gen_results(orig_cmd, metric, pmap, n, shuf_cmd, local,
+                                  seed, piped, exact_n))
 
 
 @command('bed-sample')
-def bed_sample(bed, n=100):
+def bed_sample(bed, n=100, seed=None):
     """\
-    Choose n random lines from a bed file. Uses reservoir sampling.
+    Choose n random lines from a bed file. Uses reservoir sampling with
+    Li's Algorithm L, which draws the number of lines to skip between
+    replacements so only O(n log(N / n)) random numbers are needed.
 
     Arguments:
         bed - a bed file
         n - number of lines to sample
+        seed - seed for the random number generator
     """
-    n, lines = int(n), []
-    from random import randint
+    n = int(n)
+    rng = Random(None if seed is None else int(seed))
+    random, randrange = rng.random, rng.randrange
+    from math import exp, log
+    from itertools import islice
     with nopen(bed) as fh:
-        for i, line in enumerate(nopen(fh)):
-            if i < n:
-                lines.append(line)
-            else:
-                replace_idx = randint(0, i)
-                if replace_idx < n:
-                    lines[replace_idx] = line
-        print("".join(lines), end="")
+        lines = list(islice(fh, n))
+        if len(lines) == n > 0:
+            w = exp(log(random()) / n)
+            while True:
+                skip = int(log(random()) / log(1 - w))
+                line = next(islice(fh, skip, None), None)
+                if line is None: break
+                lines[randrange(n)] = line
+                w *= exp(log(random()) / n)
+        # write the sampled lines directly rather than joining a copy.
+        sys.stdout.writelines(lines)
 
 
 @command('local-shuffle')
-def local_shuffle(bed, loc='500000'):
+def local_shuffle(bed, loc='500000', seed=None):
     """
     Randomize the location of each interval in `bed` by moving its
     start location to within `loc` bp of its current location or to
@@ -180,15 +609,15 @@ def local_shuffle(bed, loc='500000'):
                If not an integer, then this should be a BED file containing
                regions such that each interval in `bed` is shuffled within
                its containing interval in `loc`
+        seed - seed for the random number generator
     """
-    from random import randint
+    rng = Random(None if seed is None else int(seed))
+    randint = rng.randint
     if str(loc).isdigit():
         dist = abs(int(loc))
         with nopen(bed) as fh:
-            for toks in (l.rstrip('\r\n').split('\t') for l in fh):
-                d = randint(-dist, dist)
-                toks[1:3] = [str(max(0, int(bloc) + d)) for bloc in toks[1:3]]
-                print("\t".join(toks))
+            lines = [l.rstrip('\r\n') for l in fh]
+        sys.stdout.writelines(shift_lines(lines, dist, rng))
     else:
         # we are using dist as the windows within which to shuffle
         assert os.path.exists(loc)
@@ -225,38 +654,109 @@ def local_shuffle(bed, loc='500000'):
 
             print("\t".join(a))
         if missing > 0:
-            print >> sys.stderr, ("found {missing} intervals in {bed} that "
-                                  " were not contained in {loc}"
-                                  .format(**locals()))
+            print(("found {missing} intervals in {bed} that "
+                   " were not contained in {loc}".format(**locals())),
+                  file=sys.stderr)
 
 
-def zclude(bed, other, exclude=True):
+def is_count_only(metric):
     """
-    Include or exclude intervals from bed that overlap other.
-    If exclude is True:
-        new = bedtools intersect -v -a bed -o other
+    True if the only metric is the default 'wc -l' that counts the
+    overlapping pairs.
+    """
+    metrics = metric if isinstance(metric, (tuple, list)) else [metric]
+    return all(m == 'wc -l' for m in metrics)
+
+
+def bed3(bed):
+    """
+    Copy the chrom, start, end columns of `bed` to a new file. If only the
+    number of overlaps is needed, this means bedtools does not parse, and
+    print into each intersection, the remaining columns for every shuffle.
     """
-    if other is None: return bed
-    n_orig = sum(1 for _ in nopen(bed))
     tmp = mktemp()
-    if exclude:
-        run("bedtools intersect -v -a {bed} -b {other} > {tmp}; echo 1"
-            .format(**locals()))
-    else:
-        run("bedtools intersect -u -a {bed} -b {other} > {tmp}; echo 1"
-            .format(**locals()))
+    with open(tmp, 'w') as fh:
+        fh.writelines("\t".join(l.rstrip("\r\n").split("\t", 3)[:3]) + "\n"
+                      for l in nopen(bed))
+    return tmp
+
+
+def split_bed(bed, tmpdir, nparts):
+    """
+    Split the intervals in `bed` into about `nparts` files of consecutive
+    lines in `tmpdir`. Each file ends where the chromosome changes, so a
+    sorted `bed` gives whole chromosomes, and only one file is open at a
+    time. Returns the paths, in the order of `bed`, and the number of
+    intervals.
+    """
+    n = sum(1 for l in nopen(bed) if not is_header(l))
+    size = max(1, -(-n // int(nparts)))
+    paths, fh, k, last = [], None, 0, None
+    for line in nopen(bed):
+        if is_header(line): continue
+        chrom = line.split("\t", 1)[0]
+        if fh is None or (k >= size and chrom != last):
+            if fh is not None: fh.close()
+            fh = open(os.path.join(tmpdir, "%d.bed" % len(paths)), "w")
+            paths.append(fh.name)
+            k = 0
+        fh.write(line if line.endswith("\n") else line + "\n")
+        k, last = k + 1, chrom
+    if fh is not None: fh.close()
+    return paths, n
+
+
+def filter_bed(bed, exclude=None, include=None, ncpus=NCPUS):
+    """
+    Exclude intervals from bed that overlap `exclude` and then keep only those
+    that overlap `include` in a single pipeline:
+        bedtools intersect -v -a bed -b exclude \
+            | bedtools intersect -u -a stdin -b include
+    so no intermediate file is written between the two.
+    bedtools is single-threaded, so `bed` is split into about `ncpus` parts
+    (see split_bed) that are filtered at once and then joined in order.
+    """
+    if exclude is None and include is None: return bed
+    tmp, tmpdir = mktemp(), mkdtemp()
+    atexit.register(rmtree, tmpdir, True)
+    parts, n_orig = split_bed(bed, tmpdir, ncpus)
+    cmds, src, cludes = [], '"$1"', []
+    if exclude is not None:
+        cmds.append("bedtools intersect -v -a {src} -b {exclude}"
+                    .format(**locals()))
+        cludes.append("excluding %s" % exclude)
+        src = "stdin"
+    if include is not None:
+        cmds.append("bedtools intersect -u -a {src} -b {include}"
+                    .format(**locals()))
+        cludes.append("including %s" % include)
+    # each part gets its own output so the results can't interleave.
+    bash, pipeline = BASH, quote('set -o pipefail; %s > "$1.out"' %
+                                 " | ".join(cmds))
+    files = " ".join(quote(p) for p in parts)
+    outs = " ".join(quote(p + ".out") for p in parts)
+    script = ("printf '%s\\n' {files} "
+              "| xargs -r -n 1 -P {ncpus} {bash} -c {pipeline} _ "
+              "&& cat /dev/null {outs} > {tmp}".format(**locals()))
+    # a failed part would silently drop its rows, so check the status.
+    proc = popen(script)
+    err = proc.communicate()[1].strip()
+    if proc.returncode != 0:
+        sys.stderr.write("%s\n%s\n%s\n" % (script, err, proc.returncode))
+        raise Exception(err)
+    if err: sys.stderr.write(err)
     n_after = sum(1 for _ in nopen(tmp))
-    clude = "exclud" if exclude else "includ"
+    clude = " and ".join(cludes)
     pct = 100 * float(n_orig - n_after) / n_orig
     print(("reduced {bed} from {n_orig} to {n_after} "
-             "{pct:.3f}% by {clude}ing {other}").format(**locals()), file=sys.stderr)
+             "{pct:.3f}% by {clude}").format(**locals()), file=sys.stderr)
     return tmp
 
 
 def get_pmap(ncpus):
     if ncpus in ('1', 1, None):
         pmap = map
-    elif isinstance(ncpus, (basestring, int)):
+    elif isinstance(ncpus, (str, int)):
         ncpus = int(ncpus)
         if ncpus == -1: ncpus = cpu_count()
         pool = Pool(ncpus)
@@ -270,7 +770,13 @@ def get_pmap(ncpus):
         atexit.register(term)
         ############################################################
 
-        pmap = pool.imap
+        def pmap(fn, args):
+            # only the sums of the results are used so order doesn't matter.
+            # hand each worker several tasks at a time to cut queue traffic.
+            chunksize = max(1, length_hint(args, 1) // (ncpus * 4))
+            return pool.imap_unordered(fn, args, chunksize)
+        # lets gen_results hand shell metrics to xargs instead of the pool.
+        pmap.ncpus = ncpus
     else:
         pmap = ncpus
         assert hasattr(pmap, "__call__"), pmap
@@ -280,7 +786,8 @@ def get_pmap(ncpus):
 @command('poverlap')
 def poverlap(a, b, genome=None, metric='wc -l', n=100, chrom=False,
              exclude=None, include=None, shuffle_both=False,
-             overlap_distance=0, shuffle_loc=None, ncpus=-1):
+             overlap_distance=0, shuffle_loc=None, ncpus=-1, seed=None,
+             exact_n=False):
     """\
     poverlap is the main function that parallelizes testing overlap between `a`
     and `b`. It performs `n` shufflings and compares the observed number of
@@ -314,6 +821,11 @@ def poverlap(a, b, genome=None, metric='wc -l', n=100, chrom=False,
                       containing interval in `shuffle_loc`.
         ncpus - number cpus to use -- if a callable does the parallelization
                 use, e.g. Pool(5).map or Ipython Client[:].map
+        seed - seed for the shuffles; runs with the same seed give the same
+               result. Default is a random seed.
+        exact_n - always run all `n` shuffles. By default, shuffling stops
+                  early once the p-value is clearly below 0.001 or above
+                  0.5 (after at least 100 shuffles).
     """
     pmap = get_pmap(ncpus)
 
@@ -326,55 +838,160 @@ def poverlap(a, b, genome=None, metric='wc -l', n=100, chrom=False,
     if genome is None: assert shuffle_loc
 
     # limit exclude and then to include
-    a = zclude(zclude(a, exclude, True), include, False)
-    b = zclude(zclude(b, exclude, True), include, False)
+    # run as many of the filters at once as the shuffles would.
+    a = filter_bed(a, exclude, include, getattr(pmap, 'ncpus', 1))
+    b = filter_bed(b, exclude, include, getattr(pmap, 'ncpus', 1))
 
     exclude = "" if exclude is None else ("-excl %s" % exclude)
     include = "" if include is None else ("-incl %s" % include)
 
-    if overlap_distance != 0:
+    metrics = metric if isinstance(metric, (tuple, list)) else [metric]
+    local = piped = None
+    if str(shuffle_loc).isdigit() and 'wc -l' in metrics:
+        # the default count is done in-process, see LocalOverlap
+        local = LocalOverlap(a, b, shuffle_loc, shuffle_both,
+                             overlap_distance)
+
+    copies = {}
+    if local is None and is_count_only(metrics):
+        copies = {bed3(a): a, bed3(b): b}
+        a, b = list(copies)
+
+    # LocalOverlap extends in memory so only write extended files if some
+    # other metric will send them to bedtools.
+    if overlap_distance != 0 and (local is None or
+                                  any(m != 'wc -l' for m in metrics)):
         a = extend_bed(a, mktemp(), overlap_distance)
         b = extend_bed(b, mktemp(), overlap_distance)
 
     orig_cmd = "bedtools intersect -wo -a {a} -b {b}".format(**locals())
 
     if shuffle_loc is None:
-        # use bedtools shuffle
+        # use bedtools shuffle. $seed is set for each shuffle by gen_results
         if shuffle_both:
             a = ("<(bedtools shuffle -allowBeyondChromEnd {exclude} {include} -i {a} -g {genome} "
-                 "{chrom})".format(**locals()))
+                 "{chrom} -seed $((seed + 1)))".format(**locals()))
         shuf_cmd = ("bedtools intersect -wo -a {a} -b "
                     "<(bedtools shuffle -allowBeyondChromEnd {exclude} {include} -i {b} -g {genome}"
-                    " {chrom})".format(**locals()))
+                    " {chrom} -seed $seed)".format(**locals()))
     else:
         # use python shuffle ignores --chrom and --genome
-        script = __file__
+        # run the subcommands with this interpreter, e.g. pypy3
+        python, script = sys.executable, __file__
         if shuffle_both:
-            a = "<(python {script} local-shuffle {a} --loc {shuffle_loc})"\
-                .format(**locals())
+            a = ("<({python} {script} local-shuffle {a} --loc {shuffle_loc} "
+                 "--seed $((seed + 1)))").format(**locals())
         shuf_cmd = ("bedtools intersect -wo -a {a} -b "
-                    "<(python {script} local-shuffle {b} --loc {shuffle_loc})"
-                    ).format(**locals())
+                    "<({python} {script} local-shuffle {b} --loc {shuffle_loc} "
+                    "--seed $seed)").format(**locals())
+        if str(shuffle_loc).isdigit() and not is_count_only(metrics):
+            # other metrics get the shuffled b on stdin, see PipedShuffle
+            piped = PipedShuffle("bedtools intersect -wo -a {a} -b stdin"
+                                 .format(**locals()), b,
+                                 dist=abs(int(shuffle_loc)))
 
-    return json.dumps(gen_results(orig_cmd, metric, pmap, n, shuf_cmd))
+    # the bed3 copies are removed at exit, so report the files they came from.
+    report_cmd = shuf_cmd
+    for copy, orig in copies.items():
+        report_cmd = report_cmd.replace(copy, orig)
 
+    return json.dumps(gen_results(orig_cmd, metric, pmap, n, shuf_cmd, local,
+                                  seed, piped, exact_n, report_cmd))
 
-def gen_results(orig_cmd, metric, pmap, n, shuf_cmd=None):
+
+def simulate(seeds, met, pmap, shuf_cmd, local=None, piped=None, pool=None):
+    """
+    values of the metric `met` for a shuffle with each of `seeds`, using
+    `local` or `piped` (see gen_results) when they apply. If `pool` is a
+    `trials_pool` for `local`, its trials run there rather than in pmap.
+    """
+    if local is not None and met == 'wc -l':
+        if pool is not None:
+            batches = split_seeds(seeds, 4 * pmap.ncpus)
+            return chain.from_iterable(pool.imap_unordered(run_trials, batches))
+        return chain.from_iterable(pmap(local.trials, split_seeds(seeds)))
+    if piped is not None:
+        return pmap(piped, [(met, s) for s in seeds])
+    if isinstance(met, str):
+        ncpus = getattr(pmap, 'ncpus', None)
+        if ncpus is not None:
+            return run_xargs(shuf_cmd, met, seeds, ncpus)
+        batches = [(shuf_cmd, met, b) for b in split_seeds(seeds)]
+        return chain.from_iterable(pmap(run_batch, batches))
+    return pmap(run_metric, [("seed=%d; %s" % (s, shuf_cmd), met)
+                             for s in seeds])
+
+
+def wilson_interval(k, n, z=2.576):
+    """
+    Wilson score interval for the proportion k / n. z=2.576 gives 99%.
+    """
+    p, z2 = k / float(n), z * z
+    centre = (p + z2 / (2 * n)) / (1 + z2 / n)
+    half = z * sqrt(p * (1 - p) / n + z2 / (4 * n * n)) / (1 + z2 / n)
+    return centre - half, centre + half
+
+
+def gen_results(orig_cmd, metric, pmap, n, shuf_cmd=None, local=None,
+                seed=None, piped=None, exact_n=False, report_cmd=None):
+    """
+    if `local` is given, it is used in place of `orig_cmd` and `shuf_cmd`
+    for the default 'wc -l' metric. if `piped` is given, it is used in place
+    of `shuf_cmd` for the other metrics.
+    `shuf_cmd` is run with $seed set to one of `n` seeds drawn from `seed`.
+    The reported shuffle_cmd is the command run for each shuffle: `piped.cmd`
+    when `piped` is used. `local` runs no command, so for it shuffle_cmd is
+    the equivalent shell command. `report_cmd`, if given, is reported in
+    place of `shuf_cmd`.
+
+    Unless `exact_n` is set, the shuffles are run in batches and stop early
+    once the 99% interval of the p-value is entirely below P_LOW or above
+    P_HIGH. At least MIN_SHUFFLES are run, so batches hold that many or, if
+    more, 4 per cpu, and `n` <= MIN_SHUFFLES is run as a single batch.
+    """
     if not isinstance(metric, (tuple, list)):
         metric = [metric]
+    seeds = trial_seeds(n, seed)
+    # each batch starts the shells or pool tasks afresh, so keep them few.
+    size = n if exact_n else max(MIN_SHUFFLES,
+                                 getattr(pmap, 'ncpus', NCPUS) * 4)
+    batches = [seeds[i:i + size] for i in range(0, n, size)]
     full_res = {}
+    # the in-process counts run in worker processes if pmap is our own pool.
+    pool = None
+    if local is not None and getattr(pmap, 'ncpus', 1) > 1:
+        pool = trials_pool(local, pmap.ncpus)
     for met in metric:
-        observed = run_metric(orig_cmd, met)
-        res = {"observed": observed, "shuffle_cmd": shuf_cmd}
-        sims = [int(x) for x in pmap(run_metric, [(shuf_cmd, met)] * n)]
+        in_process = local is not None and met == 'wc -l'
+        if in_process:
+            observed = local.count()
+        else:
+            observed = run_metric(orig_cmd, met)
+        cmd = report_cmd or shuf_cmd
+        if not in_process and piped is not None: cmd = piped.cmd
+
+        n_sims = total = n_ge = 0
+        for batch in batches:
+            # consume the results as they arrive rather than storing them.
+            for sim in simulate(batch, met, pmap, shuf_cmd, local,
+                                piped, pool):
+                sim = int(sim)
+                n_sims += 1
+                total += sim
+                n_ge += sim >= observed
+            if not exact_n and n_sims >= MIN_SHUFFLES:
+                lo, hi = wilson_interval(n_ge, n_sims)
+                if hi < P_LOW or lo > P_HIGH: break
+
+        res = {"observed": observed, "shuffle_cmd": cmd}
         res['metric'] = repr(met)
-        res['simulated mean metric'] = (sum(sims) / float(len(sims)))
+        res['shuffles'] = n_sims
+        res['simulated mean metric'] = total / float(n_sims)
 
         # lowest possible p is 1 / (1 + n_sims)
-        res['simulated_p'] = \
-            ((1 + sum((s >= observed) for s in sims)) / (1 + float(len(sims))))
-        #res['sims'] = sims
+        res['simulated_p'] = (1 + n_ge) / (1 + float(n_sims))
         full_res[repr(met)] = res
+    if pool is not None: pool.terminate()
     return full_res
 
 def main():
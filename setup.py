@@ -18,7 +18,9 @@ setup(name='poverlap',
       # Get strings from http://pypi.python.org/pypi?%3Aaction=list_classifiers
       'Topic :: Scientific/Engineering',
       'Topic :: Scientific/Engineering :: Bio-Informatics',
-      'Topic :: Utilities'
+      'Topic :: Utilities',
+      'Programming Language :: Python :: 3',
+      'Programming Language :: Python :: Implementation :: PyPy',
     ],
     keywords='bioinformatics',
     author='Brent Pedersen',
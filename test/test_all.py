@@ -12,56 +12,165 @@ def mymetric(fh):
 def check_attributes(res):
     d = json.loads(res)
     assert len(d) > 0
-    d = d.itervalues().next()
+    d = next(iter(d.values()))
     for k in ("metric", "observed", "shuffle_cmd"):
         assert k in d, (k, d)
 
 def test_python_metric():
 
     res = poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome', metric=mymetric, n=20)
-    assert isinstance(res, basestring)
-    yield check_attributes, res
+    assert isinstance(res, str)
+    check_attributes(res)
 
 def test_string_metric():
     res = poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome',
             metric='wc -l', n=20)
-    assert isinstance(res, basestring)
-    yield check_attributes, res
+    assert isinstance(res, str)
+    check_attributes(res)
 
 def test_local():
     res = poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome',
             shuffle_loc=100, n=20)
-    assert isinstance(res, basestring)
-    yield check_attributes, res
+    assert isinstance(res, str)
+    check_attributes(res)
 
 def test_fixle():
     res = fixle('test/data/haim.test.bed', 'CTCF', 'Pol2', n=20)
     d = json.loads(res)
     assert len(d) == 1
-    yield check_attributes, res
+    check_attributes(res)
 
 def test_map_fn():
     res = poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome',
-            metric='wc -l', n=20, ncpus=map)
-    assert isinstance(res, basestring)
-    yield check_attributes, res
-    from itertools import imap
+            metric='wc -l', n=20, ncpus=lambda fn, args: list(map(fn, args)))
+    assert isinstance(res, str)
+    check_attributes(res)
     res = poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome',
-            metric='wc -l', n=20, ncpus=imap)
-    assert isinstance(res, basestring)
-    yield check_attributes, res
+            metric='wc -l', n=20, ncpus=map)
+    assert isinstance(res, str)
+    check_attributes(res)
 
 def test_cpu_count():
 
     res = poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome',
             metric='wc -l', n=20, ncpus=2)
-    assert isinstance(res, basestring)
-    yield check_attributes, res
+    assert isinstance(res, str)
+    check_attributes(res)
 
 def test_multi_metric():
     res = poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome',
             metric=('wc -l', mymetric), n=20, ncpus=2)
-    assert isinstance(res, basestring)
+    assert isinstance(res, str)
     d = json.loads(res)
     assert len(d) == 2, d
 
+
+def test_local_overlap():
+    from poverlap import LocalOverlap, run_metric
+    local = LocalOverlap('test/data/a.bed', 'test/data/b.bed', 100)
+    observed = run_metric("bedtools intersect -wo -a test/data/a.bed "
+                          "-b test/data/b.bed", "wc -l")
+    assert local.count() == observed, (local.count(), observed)
+
+def test_local_overlap_distance():
+    from poverlap import LocalOverlap, run_metric, extend_bed, mktemp
+    local = LocalOverlap('test/data/a.bed', 'test/data/b.bed', 100,
+                         overlap_distance=40000)
+    a = extend_bed('test/data/a.bed', mktemp(), 40000)
+    b = extend_bed('test/data/b.bed', mktemp(), 40000)
+    observed = run_metric("bedtools intersect -wo -a %s -b %s" % (a, b),
+                          "wc -l")
+    assert local.count() == observed, (local.count(), observed)
+
+def simulated(res):
+    # the results without shuffle_cmd, which names each run's temp files.
+    keys = ("observed", "shuffles", "simulated mean metric", "simulated_p")
+    return [[d[k] for k in keys] for d in json.loads(res).values()]
+
+def test_seed():
+    res = [poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome',
+                    metric='wc -l', n=20, seed=42) for _ in range(2)]
+    assert simulated(res[0]) == simulated(res[1]), res
+    res = [fixle('test/data/haim.test.bed', 'CTCF', 'Pol2', n=20, seed=42)
+           for _ in range(2)]
+    assert simulated(res[0]) == simulated(res[1]), res
+
+def test_sample_overlap():
+    from poverlap import SampleOverlap, run_metric
+    local = SampleOverlap('test/data/a.bed', 'test/data/b.bed',
+                          'test/data/b.bed', 1000)
+    observed = run_metric("bedtools intersect -wo -a test/data/a.bed "
+                          "-b test/data/b.bed", "wc -l")
+    assert local.count() == observed, (local.count(), observed)
+    # sampling all of b gives back b.
+    from random import Random
+    assert local.count(Random(1)) == observed
+
+def test_exact_n():
+    res = poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome',
+            metric='wc -l', n=20, exact_n=True)
+    d = next(iter(json.loads(res).values()))
+    assert d['shuffles'] == 20, d
+    res = poverlap('test/data/a.bed', 'test/data/b.bed', 'data/hg19.genome',
+            metric='wc -l', n=20)
+    d = next(iter(json.loads(res).values()))
+    # too few to stop early.
+    assert d['shuffles'] == 20, d
+
+def test_empty_intervals():
+    from poverlap import LocalOverlap, SampleOverlap, mktemp
+
+    def bed(*rows):
+        with open(mktemp(), "w") as fh:
+            fh.write("track name=test\n# comment\n\n")
+            fh.writelines("chr1\t%d\t%d\n" % row for row in rows)
+        return fh.name
+
+    def brute(a, b):
+        return sum(as_ < be and ae > bs for as_, ae in a for bs, be in b)
+
+    a, b = [(100, 100), (50, 150)], [(100, 100), (120, 130)]
+    assert brute(a, b) == 2
+    local = LocalOverlap(bed(*a), bed(*b), 0)
+    assert local.count() == 2, local.count()
+    assert SampleOverlap(bed(*a), bed(*b), bed(*b), 2).count() == 2
+    # extended by -60 each, both collapse to 150 150.
+    local = LocalOverlap(bed((100, 200)), bed((140, 160)), 0,
+                         overlap_distance=-120)
+    assert local.count() == 0, local.count()
+    # shifts below 0 are clamped to empty intervals at 0.
+    from random import Random
+    from poverlap import shift_offsets
+    a, b = [(0, 0), (0, 5), (2, 30)], [(3, 8), (0, 0)]
+    local = LocalOverlap(bed(*a), bed(*b), 50)
+    for seed in range(20):
+        d = shift_offsets(len(b), 50, Random(seed))
+        shifted = [(max(0, s + o), max(0, e + o)) for (s, e), o in zip(b, d)]
+        assert local.count(Random(seed)) == brute(a, shifted), seed
+
+def test_early_stop():
+    # shuffling a against itself by 0 bases never changes the count, so p is
+    # 1 and shuffling stops after the minimum.
+    from poverlap import MIN_SHUFFLES
+    res = poverlap('test/data/a.bed', 'test/data/a.bed', 'data/hg19.genome',
+            metric='wc -l', n=1000, shuffle_loc=0)
+    d = next(iter(json.loads(res).values()))
+    assert MIN_SHUFFLES <= d['shuffles'] < 1000, d
+    assert d['simulated_p'] == 1, d
+
+def test_pickle_overlap():
+    # trials_pool and process-based maps get the object through pickle.
+    import pickle
+    from random import Random
+    from poverlap import LocalOverlap, SampleOverlap, run_trials, init_trials
+    local = LocalOverlap('test/data/a.bed', 'test/data/b.bed', 100)
+    copy = pickle.loads(pickle.dumps(local))
+    assert isinstance(copy, LocalOverlap)
+    assert copy.count() == local.count()
+    assert copy.count(Random(3)) == local.count(Random(3))
+    init_trials(LocalOverlap, local.args)
+    assert run_trials([1, 2]) == local.trials([1, 2])
+    local = SampleOverlap('test/data/a.bed', 'test/data/b.bed',
+                          'test/data/b.bed', 100)
+    copy = pickle.loads(pickle.dumps(local))
+    assert copy.count(Random(3)) == local.count(Random(3))